@@ -2,6 +2,18 @@ import os
 import re
 import json
 import base64
+import html
+import hashlib
+import collections
+import decimal
+import statistics
+import datetime
+import threading
+import time
+import sqlite3
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
@@ -9,24 +21,99 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import Generation
+from langchain_community.cache import SQLiteCache
 from langchain_community.utilities import SQLDatabase
+from sqlalchemy import text
 from streamlit_option_menu import option_menu
-from openai import OpenAI
+from openai import NOT_GIVEN, OpenAI
+import httpx
 import logging
 from urllib.parse import quote_plus
 from PIL import Image
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 from streamlit_oauth import OAuth2Component
+from fastembed import TextEmbedding
+import tiktoken
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+OPENAI_TIMEOUT_S = 10
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client() -> OpenAI:
+    # One client per process, so the keep-alive pool to api.openai.com survives reruns
+    # HTTP/2 lets the SQL and answer calls share one TLS connection
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        timeout=OPENAI_TIMEOUT_S
+    )
+    # Bounded retries and timeout instead of the SDK's 600 s default
+    return OpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=2, timeout=OPENAI_TIMEOUT_S)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_cache() -> SQLiteCache:
+    # Exact-match cache for chat completions. SQLite-backed so hits survive app
+    # restarts; built once per process so reruns don't recreate its engine.
+    return SQLiteCache(database_path=".llm_cache.db")
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+_SQL_PREFIX_RE = re.compile(r'^(?:SQL:?\s*)', re.IGNORECASE)
+# One pass over the schema: (table, body) for every table. The body is empty
+# unless the definition closes with ");" before the next CREATE TABLE.
+_SCHEMA_RE = re.compile(r'CREATE TABLE (\w+)\s*\((?:((?:(?!CREATE TABLE).)*?)\)\s*;)?', re.DOTALL)
+_COL_RE = re.compile(r'(\w+)\s+\w+')
+_WORD_RE = re.compile(r'\w+')
+_WHITESPACE_RE = re.compile(r'\s+')
+# A quoted SQL string literal or identifier
+_SQL_QUOTED_RE = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|`[^`]*`""")
+
+# LLM settings and system messages, built once rather than on every chat turn
+LLM_MODEL = "gpt-4o-mini"
+# SQL generation emits one line of SQL, so it uses a modest token cap that
+# still covers joins and GROUP BYs plus the {"sql": ...} JSON envelope. The
+# structured output has no prose or fences.
+SQL_MODEL = "gpt-4o-mini"
+SQL_MAX_TOKENS = 256
+SQL_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "sql_query",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"sql": {"type": "string"}},
+            "required": ["sql"],
+            "additionalProperties": False,
+        },
+    },
+}
+ANSWER_MAX_TOKENS = 120
+# Static instructions go first and the volatile chat history/question last, so
+# consecutive requests share a byte-identical prefix for provider prompt caching.
+SQL_SYSTEM_MESSAGE = {"role": "system", "content": """You are a SQL generator.
+Generate a SQL query that answers the user's question using the table described in the schema.
+If the question has the word "latest" in it, the column name is "transaction_date"
+and if asked about the word "order" then the table is "purchase_order".
+Return the query as ONE line of SQL in the "sql" field."""}
+ANSWER_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful data analyst."}
+
+SCHEMA_TEMPLATE = "<SCHEMA>Table '{table}' with columns {columns}</SCHEMA>"
+QUESTION_TEMPLATE = 'Recent chat history: {history}\nQuestion: "{question}"'
+ANSWER_TEMPLATE = """
+For the question: "{question}"
+The SQL query: {query}
+Returned this result: {result}
+
+Provide a clear and concise answer to the user's question. Be concise, under 40 words.
+"""
+
 # Google OAuth2 Configuration
 CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
@@ -47,149 +134,922 @@ flow = Flow.from_client_config(
 # Initialize the OAuth2Component
 oauth2 = OAuth2Component(CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
 
-def get_table_and_columns(db: SQLDatabase, user_query: str) -> Tuple[str, List[str]]:
-    schema = db.get_table_info()
+@st.cache_data(ttl=600, show_spinner=False)
+def _schema_for(_db: SQLDatabase, uri_fingerprint: str) -> str:
+    # _db is not hashed by Streamlit; the fingerprint makes a different database a cache miss
+    return _db.get_table_info()
+
+def db_fingerprint(db: SQLDatabase) -> str:
+    # str() of a SQLAlchemy URL masks the password
+    return hashlib.sha1(str(db._engine.url).encode()).hexdigest()
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _schema_hash_for(_db: SQLDatabase, uri_fingerprint: str) -> str:
+    return hashlib.md5(_schema_for(_db, uri_fingerprint).encode()).hexdigest()
 
-    # Extract table names from schema
-    table_names = re.findall(r'CREATE TABLE (\w+)', schema)
+def get_schema_hash(db: SQLDatabase) -> str:
+    """Changes whenever the schema does, so answer caches keyed on it go stale with it."""
+    return _schema_hash_for(db, db_fingerprint(db))
 
-    # Simple keyword matching to find the most relevant table
-    relevant_table = max(table_names, key=lambda table: sum(word.lower() in user_query.lower() for word in table.split('_')), default=None)
+@st.cache_data(ttl=600, show_spinner=False)
+def _schema_index_for(_db: SQLDatabase, uri_fingerprint: str) -> Dict[str, List[str]]:
+    """Parse the schema once into {table: [columns]}, in schema order."""
+    schema = _schema_for(_db, uri_fingerprint)
+    return {table: _COL_RE.findall(body) for table, body in _SCHEMA_RE.findall(schema)}
 
-    if not relevant_table:
+@st.cache_data(ttl=600, show_spinner=False)
+def _token_index_for(_db: SQLDatabase, uri_fingerprint: str) -> Dict[str, set]:
+    """Inverted index of lowercased table-name words, e.g. {'order': {'purchase_order'}}."""
+    token_to_tables = collections.defaultdict(set)
+    for table in _schema_index_for(_db, uri_fingerprint):
+        for word in table.lower().split('_'):
+            token_to_tables[word].add(table)
+    return dict(token_to_tables)
+
+def warm_schema_cache(db: SQLDatabase):
+    """Fetch and parse the schema up front so table selection is a pure lookup."""
+    fingerprint = db_fingerprint(db)
+    _schema_index_for(db, fingerprint)
+    _token_index_for(db, fingerprint)
+
+def clear_schema_caches():
+    _schema_for.clear()
+    _schema_index_for.clear()
+    _token_index_for.clear()
+    _schema_hash_for.clear()
+
+def get_table_and_columns(db: SQLDatabase, user_query: str) -> Tuple[str, List[str]]:
+    fingerprint = db_fingerprint(db)
+    schema_index = _schema_index_for(db, fingerprint)
+    if not schema_index:
         return None, []
+    token_to_tables = _token_index_for(db, fingerprint)
 
-    # Extract column names for the relevant table
-    table_schema = re.search(f'CREATE TABLE {relevant_table} \((.*?)\);', schema, re.DOTALL)
-    if table_schema:
-        columns = re.findall(r'(\w+)\s+\w+', table_schema.group(1))
-        return relevant_table, columns
+    # Score each table by how many query words name part of it; "orders" also tries "order"
+    scores = collections.Counter()
+    for token in set(_WORD_RE.findall(user_query.lower())):
+        for variant in {token, token.rstrip('s')}:
+            scores.update(token_to_tables.get(variant, ()))
 
-    return relevant_table, []
+    # Ties (including no match at all) go to the first table in schema order
+    relevant_table = max(schema_index, key=scores.__getitem__)
+    return relevant_table, schema_index[relevant_table]
 
 def clean_sql_query(query):
-    return re.sub(r'^(SQL:?\s*)?', '', query, flags=re.IGNORECASE).strip()
+    cleaned = _SQL_PREFIX_RE.sub('', query, count=1).strip().rstrip(';').rstrip()
+    # Only read queries are ever run against the user's database
+    if not _SELECT_RE.match(cleaned):
+        logging.warning(f"Rejecting non-SELECT statement: {cleaned}")
+        return None
+    # A ";" outside a quoted literal means stacked statements, e.g. "SELECT 1; DELETE ..."
+    if ';' in _SQL_QUOTED_RE.sub('', cleaned):
+        logging.warning(f"Rejecting multi-statement query: {cleaned}")
+        return None
+    return cleaned
+
+# Pool shared by every session using this connection (the engine is a cached
+# resource). 10 warm connections covers a handful of concurrent chats; overflow
+# absorbs bursts. pre_ping replaces dead sockets before use, and recycling
+# below MySQL's wait_timeout avoids "server has gone away" errors.
+DB_ENGINE_ARGS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+    # mysqlclient enables CLIENT.MULTI_STATEMENTS unless told otherwise; one
+    # statement per execute means a stacked "SELECT ...; DELETE ..." can't run
+    "connect_args": {"multi_statements": False},
+}
+
+@st.cache_resource(show_spinner=False)
+def _connect_database(user: str, _password: str, host: str, port: str, database: str, password_digest: str) -> SQLDatabase:
+    # _password is skipped by Streamlit's hasher; password_digest keeps a wrong
+    # password from being served the engine cached for the right one.
+    db_uri = f"mysql+mysqldb://{quote_plus(user)}:{quote_plus(_password)}@{quote_plus(host)}:{quote_plus(port)}/{quote_plus(database)}"
+    logging.info(f"Connecting to database {database} on {host}:{port} as {user}")
+    return SQLDatabase.from_uri(db_uri, engine_args=DB_ENGINE_ARGS)
 
 def init_database(user: str, password: str, host: str, port: str, database: str) -> SQLDatabase:
     try:
-        db_uri = f"mysql+mysqlconnector://{quote_plus(user)}:{quote_plus(password)}@{quote_plus(host)}:{quote_plus(port)}/{quote_plus(database)}"
-        logging.info(f"Connecting to database with URI: {db_uri}")
-        return SQLDatabase.from_uri(db_uri)
+        password_digest = hashlib.sha256(password.encode()).hexdigest()
+        return _connect_database(user, password, host, port, database, password_digest)
     except Exception as e:
         logging.error(f"Error connecting to database: {e}")
         return None
     
-def get_sql_query(db: SQLDatabase, user_query: str, chat_history: List[dict]) -> str:
+# Cap on rows pulled from MySQL and handed to the answer prompt
+MAX_ROWS = 200
+# Largest result sent to the LLM verbatim (~2k tokens); bigger ones are summarized per column
+RESULT_MAX_CHARS = 8000
+
+# Server-side statement timeout, plus a slightly longer client-side cutoff in
+# case the server ignores the hint
+QUERY_TIMEOUT_MS = 5000
+QUERY_CLIENT_TIMEOUT_S = 6
+_SELECT_RE = re.compile(r'^\s*select\s+', re.IGNORECASE)
+_LIMIT_RE = re.compile(r'\blimit\b', re.IGNORECASE)
+
+# Small results for "list/show/name ..." questions are rendered directly as a
+# table instead of paying for a second LLM call to narrate them.
+DIRECT_ANSWER_MAX_ROWS = 20
+_LIST_INTENT_RE = re.compile(r'^\s*(list|name|show|give me)\b', re.IGNORECASE)
+
+def fetch_rows(db: SQLDatabase, query: str) -> Tuple[List[str], List[tuple], bool]:
+    """Run query and return (columns, at most MAX_ROWS rows, whether rows were dropped)."""
+    # Server-side cursor: rows are fetched in batches and never fully materialized
+    with db._engine.connect().execution_options(stream_results=True, yield_per=1000) as conn:
+        result = conn.execute(text(query))
+        if not result.returns_rows:
+            return [], [], False
+        columns = list(result.keys())
+        rows = [tuple(row) for row in result.fetchmany(MAX_ROWS)]
+        truncated = result.fetchone() is not None
+        result.close()
+    return columns, rows, truncated
+
+# Identical SELECTs within this window reuse the previous rows instead of hitting MySQL
+QUERY_CACHE_TTL_S = 60
+QUERY_CACHE_SIZE = 256
+
+# A quoted literal or identifier (kept verbatim), or a run of whitespace outside one
+_SQL_WHITESPACE_RE = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+def normalize_sql(query: str) -> str:
+    """Collapse whitespace outside string literals, for use as a cache key only."""
+    return _SQL_WHITESPACE_RE.sub(lambda m: m.group(1) or ' ', query.strip())
+
+@st.cache_data(ttl=QUERY_CACHE_TTL_S, max_entries=QUERY_CACHE_SIZE, show_spinner=False)
+def _cached_rows(_db: SQLDatabase, uri_fingerprint: str, normalized_query: str, _query: str) -> Tuple[List[str], List[tuple], bool]:
+    # normalized_query is only the key; MySQL always gets the original text
+    return fetch_rows(_db, _query)
+
+def fetch_rows_cached(db: SQLDatabase, query: str) -> Tuple[List[str], List[tuple], bool]:
+    """fetch_rows, memoized on whitespace-normalized SQL; only SELECTs are cached."""
+    if not _SELECT_RE.match(query):
+        return fetch_rows(db, query)
+    return _cached_rows(db, db_fingerprint(db), normalize_sql(query), query)
+
+def bound_query(query: str) -> str:
+    """Cap a bare SELECT with a LIMIT and a MySQL execution-time hint."""
+    if not _SELECT_RE.match(query):
+        return query
+    query = query.strip().rstrip(';')
+    if not _LIMIT_RE.search(query):
+        # One extra row so fetch_rows can still tell the result was truncated
+        query += f" LIMIT {MAX_ROWS + 1}"
+    return _SELECT_RE.sub(f"SELECT /*+ MAX_EXECUTION_TIME({QUERY_TIMEOUT_MS}) */ ", query, count=1)
+
+def direct_answer(user_query: str, columns: List[str], rows: List[tuple], truncated: bool) -> str:
+    """Answer from the rows alone when no narration is needed, else None."""
+    if not rows:
+        return "No results found."
+    if len(rows) == 1 and len(rows[0]) == 1:
+        # An aggregate over zero rows (e.g. SUM) comes back as a single NULL
+        if rows[0][0] is None:
+            return "No matching data found."
+        return f"The answer is {rows[0][0]}."
+    if not truncated and len(rows) <= DIRECT_ANSWER_MAX_ROWS and _LIST_INTENT_RE.match(user_query):
+        return rows_to_markdown(columns, rows)
+    return None
+
+def summarize_columns(columns: List[str], rows: List[tuple]) -> str:
+    """Per-column statistics, for results too large to send to the LLM row by row."""
+    lines = [f"{len(rows)} rows. Column summary:"]
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows if row[index] is not None]
+        numbers = [value for value in values if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)]
+        if values and len(numbers) == len(values):
+            lines.append(f"- {column}: min {min(numbers)}, max {max(numbers)}, mean {statistics.fmean(numbers):.4g}")
+        else:
+            top = collections.Counter(map(str, values)).most_common(3)
+            examples = ", ".join(f"{value} ({count})" for value, count in top)
+            lines.append(f"- {column}: {len(set(map(str, values)))} distinct values; most common: {examples}")
+    return "\n".join(lines)
+
+def format_rows(columns: List[str], rows: List[tuple], truncated: bool) -> str:
+    output = str(rows)
+    # Past the byte budget the rows would mostly be billed tokens; summarize instead
+    if len(output) > RESULT_MAX_CHARS:
+        output = summarize_columns(columns, rows)
+    if truncated:
+        output += f"\n... (truncated to the first {MAX_ROWS} rows)"
+    return output
+
+def _markdown_cell(value) -> str:
+    # A raw "|" or line break would end the cell or the row early
+    return _WHITESPACE_RE.sub(' ', str(value)).replace('|', '\\|')
+
+def rows_to_markdown(columns: List[str], rows: List[tuple]) -> str:
+    header = "| " + " | ".join(_markdown_cell(column) for column in columns) + " |"
+    divider = "| " + " | ".join("---" for _ in columns) + " |"
+    body = ["| " + " | ".join(_markdown_cell(value) for value in row) + " |" for row in rows]
+    return "\n".join([header, divider] + body)
+
+def _cache_key(messages: List[dict], model: str, max_tokens: int, temperature: float, response_format: dict = None) -> Tuple[str, str]:
+    # Hash the messages so the SQLite key stays small however large the schema/result prompt is
+    prompt = hashlib.blake2b(json.dumps(messages, sort_keys=True).encode(), digest_size=32).hexdigest()
+    return prompt, f"{model}:{max_tokens}:{temperature}:{json.dumps(response_format, sort_keys=True)}"
+
+def cached_chat(messages: List[dict], model: str = LLM_MODEL, max_tokens: int = 150, temperature: float = 0, response_format: dict = None) -> str:
+    # Only deterministic completions are safe to replay from the cache
+    use_cache = temperature == 0
+    prompt, llm_string = _cache_key(messages, model, max_tokens, temperature, response_format)
+
+    if use_cache:
+        cached = get_llm_cache().lookup(prompt, llm_string)
+        if cached:
+            logging.info("LLM cache hit")
+            return cached[0].text
+
+    response = get_openai_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        response_format=response_format or NOT_GIVEN
+    )
+    choice = response.choices[0]
+    text = choice.message.content
+
+    # Never replay a completion that hit max_tokens
+    truncated = choice.finish_reason == "length"
+    if truncated:
+        logging.warning(f"Completion truncated at {max_tokens} tokens")
+        if response_format:
+            # Cut-off structured output is unparseable JSON
+            return None
+
+    if use_cache and not truncated:
+        get_llm_cache().update(prompt, llm_string, [Generation(text=text)])
+    return text
+
+def stream_chat(messages: List[dict], model: str = LLM_MODEL, max_tokens: int = 150, temperature: float = 0) -> Iterator[str]:
+    """Like cached_chat, but yields the completion token by token as it arrives."""
+    use_cache = temperature == 0
+    prompt, llm_string = _cache_key(messages, model, max_tokens, temperature)
+
+    if use_cache:
+        cached = get_llm_cache().lookup(prompt, llm_string)
+        if cached:
+            logging.info("LLM cache hit")
+            yield cached[0].text
+            return
+
+    stream = get_openai_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True
+    )
+    chunks = []
+    finish_reason = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        delta = choice.delta.content
+        if delta:
+            chunks.append(delta)
+            yield delta
+
+    text = "".join(chunks)
+    # An empty stream is a failure, and an answer cut off at max_tokens is incomplete;
+    # neither is worth replaying
+    if finish_reason == "length":
+        logging.warning(f"Streamed completion truncated at {max_tokens} tokens")
+    if use_cache and text and finish_reason != "length":
+        get_llm_cache().update(prompt, llm_string, [Generation(text=text)])
+
+# Chat history kept in session state, and the token budget of it replayed into the SQL prompt
+CHAT_HISTORY_SIZE = 20
+HISTORY_MAX_TOKENS = 400
+# One long answer (e.g. a rendered table) shouldn't use up the whole window
+HISTORY_MESSAGE_MAX_CHARS = 500
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(SQL_MODEL)
+
+def _recent_history_text(history: Iterable[dict], max_tokens: int = HISTORY_MAX_TOKENS) -> str:
+    """Format the newest messages that fit in max_tokens, oldest first.
+
+    A compaction summary at the front is always kept, ahead of the window, so
+    older context is not lost once recent turns fill the budget.
+    """
+    tokenizer = get_tokenizer()
+    history = list(history)
+    summary = []
+    if history and history[0]['content'].startswith(SUMMARY_PREFIX):
+        summary = [f"{history[0]['role']}: {history[0]['content'][:HISTORY_MESSAGE_MAX_CHARS]}"]
+        history = history[1:]
+    lines = []
+    total = sum(len(tokenizer.encode(line)) for line in summary)
+    for message in reversed(history):
+        line = f"{message['role']}: {message['content'][:HISTORY_MESSAGE_MAX_CHARS]}"
+        total += len(tokenizer.encode(line))
+        if total > max_tokens:
+            break
+        lines.append(line)
+    return "\n".join(summary + lines[::-1])
+
+SUMMARY_SYSTEM_MESSAGE = {"role": "system", "content": "Summarize this conversation between a user and a data assistant in a few sentences. Keep table names, filters and figures."}
+SUMMARY_PREFIX = "(summary) "
+
+def compact_history(history: collections.deque):
+    """Fold the older half of a full history into one summary message, in place.
+
+    This is the only bound on the history (the deque has no maxlen, which would
+    evict the summary). A previous summary sits at the front of the older half,
+    so it is folded into the new one and summarization stays incremental.
+    """
+    if len(history) < CHAT_HISTORY_SIZE:
+        return
+    older = [history.popleft() for _ in range(CHAT_HISTORY_SIZE // 2)]
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in older)
+    try:
+        summary = cached_chat([SUMMARY_SYSTEM_MESSAGE, {"role": "user", "content": transcript}]).strip()
+    except Exception as e:
+        logging.error(f"Error summarizing chat history: {e}")
+        # Without a summary, fall back to just keeping the recent half
+        return
+    history.appendleft({"role": "assistant", "content": SUMMARY_PREFIX + summary})
+
+def get_sql_query(db: SQLDatabase, user_query: str, chat_history: Iterable[dict], embedding: np.ndarray = None) -> str:
     table, columns = get_table_and_columns(db, user_query)
 
     if not table:
         return None
 
-    prompt = f"""
-    Based on the table '{table}' with columns {', '.join(columns)},
-    generate a SQL query to answer: "{user_query}"
-    Recent chat history: {chat_history[-3:] if len(chat_history) > 3 else chat_history}
-    If the question has the word "latest" in it, the column name is "transaction_date"
-    and if asked about the word "order" then the table is "purchase_order".
-    Respond with only the SQL query, nothing else.
-    """
+    if embedding is not None:
+        cached_sql = sql_cache_lookup(db_fingerprint(db), table, embedding, user_query)
+        if cached_sql:
+            return cached_sql
+
+    schema_block = SCHEMA_TEMPLATE.format(table=table, columns=', '.join(columns))
+    question_block = QUESTION_TEMPLATE.format(history=_recent_history_text(chat_history), question=user_query)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a SQL query generator."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=150,
-            temperature=0
-        )
-        return clean_sql_query(response.choices[0].message.content)
+        response = cached_chat([
+            SQL_SYSTEM_MESSAGE,
+            {"role": "user", "content": schema_block},
+            {"role": "user", "content": question_block}
+        ], model=SQL_MODEL, max_tokens=SQL_MAX_TOKENS, response_format=SQL_RESPONSE_FORMAT)
+        if response is None:
+            return None
+        sql_query = clean_sql_query(json.loads(response)["sql"])
+        if embedding is not None and sql_query:
+            sql_cache_store(db_fingerprint(db), table, user_query, sql_query, embedding)
+        return sql_query
     except Exception as e:
         logging.error(f"Error generating SQL query: {e}")
         return None
 
-def get_response(user_query: str, db: SQLDatabase, chat_history: list):
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    # Shared across reruns and sessions so each turn doesn't spawn fresh threads
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat-io")
+
+# Paraphrased questions whose embeddings are this close reuse the earlier answer
+SEMANTIC_CACHE_THRESHOLD = 0.93
+SEMANTIC_CACHE_SIZE = 256
+# Answers come from a live database, so cached ones expire after an hour
+SEMANTIC_CACHE_TTL_S = 3600
+
+@st.cache_resource(show_spinner=False)
+def get_embedder() -> TextEmbedding:
+    return TextEmbedding("sentence-transformers/all-MiniLM-L6-v2")
+
+def embed(text: str) -> np.ndarray:
+    vector = next(iter(get_embedder().embed([text])))
+    return vector / np.linalg.norm(vector)
+
+def normalize_question(user_query: str) -> str:
+    return _WHITESPACE_RE.sub(' ', user_query.strip().lower())
+
+# "and for 2024?", "what about it" etc. only make sense with the previous turn,
+# so their cached answers (keyed on the question alone) would be wrong
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(and|but|also|then|what about|how about)\b|\b(it|its|that|those|these|them|they|same|previous|above)\b",
+    re.IGNORECASE
+)
+# Numbers, dates and quoted values; paraphrases that differ in these ask for different data
+_LITERAL_RE = re.compile(r"\d+(?:[.,:/-]\d+)*|'[^']*'|\"[^\"]*\"")
+
+def is_follow_up(user_query: str) -> bool:
+    return bool(_FOLLOW_UP_RE.search(user_query))
+
+def question_literals(user_query: str) -> Tuple[str, ...]:
+    return tuple(sorted(_LITERAL_RE.findall(user_query.lower())))
+
+def _semantic_cache(db: SQLDatabase) -> dict:
+    """This session's answer cache for the database's current schema.
+
+    Embeddings live in one preallocated float32 matrix so a lookup is a single
+    matrix-vector product; rows are recycled least-recently-used first, and
+    rows older than SEMANTIC_CACHE_TTL_S are treated as misses.
+    """
+    caches = st.session_state.setdefault("semantic_cache", {})
+    return caches.setdefault(get_schema_hash(db), {
+        "matrix": None, "questions": [], "literals": [], "answers": [], "last_used": [], "stored_at": [], "index": {},
+    })
+
+def _expired(cache: dict, now: float) -> np.ndarray:
+    return now - np.asarray(cache["stored_at"]) > SEMANTIC_CACHE_TTL_S
+
+def _touch(cache: dict, row: int):
+    cache["last_used"][row] = time.monotonic()
+
+def semantic_cache_exact(db: SQLDatabase, user_query: str) -> str:
+    """Exact match on the normalized question; needs no embedding."""
+    cache = _semantic_cache(db)
+    row = cache["index"].get(normalize_question(user_query))
+    if row is None or time.monotonic() - cache["stored_at"][row] > SEMANTIC_CACHE_TTL_S:
+        return None
+    _touch(cache, row)
+    logging.info("Semantic cache exact hit")
+    return cache["answers"][row]
+
+def semantic_cache_lookup(db: SQLDatabase, embedding: np.ndarray, user_query: str) -> str:
+    cache = _semantic_cache(db)
+    count = len(cache["answers"])
+    if not count:
+        return None
+
+    sims = cache["matrix"][:count] @ embedding.astype(np.float32)
+    sims[_expired(cache, time.monotonic())] = -np.inf
+    # A close paraphrase with different numbers or values is a different question
+    literals = question_literals(user_query)
+    sims[[cached != literals for cached in cache["literals"]]] = -np.inf
+    best = int(np.argmax(sims))
+    if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+
+    _touch(cache, best)
+    logging.info(f"Semantic cache hit ({sims[best]:.3f}) for cached question: {cache['questions'][best]}")
+    return cache["answers"][best]
+
+def semantic_cache_store(db: SQLDatabase, embedding: np.ndarray, user_query: str, answer: str):
+    cache = _semantic_cache(db)
+    question = normalize_question(user_query)
+    if cache["matrix"] is None:
+        cache["matrix"] = np.empty((SEMANTIC_CACHE_SIZE, embedding.shape[0]), dtype=np.float32)
+
+    if question in cache["index"]:
+        # Refreshing an expired answer reuses its row
+        row = cache["index"][question]
+        cache["answers"][row] = answer
+        cache["literals"][row] = question_literals(user_query)
+    elif len(cache["answers"]) < SEMANTIC_CACHE_SIZE:
+        row = len(cache["answers"])
+        cache["questions"].append(question)
+        cache["literals"].append(question_literals(user_query))
+        cache["answers"].append(answer)
+        cache["last_used"].append(0.0)
+        cache["stored_at"].append(0.0)
+    else:
+        row = int(np.argmin(cache["last_used"]))
+        del cache["index"][cache["questions"][row]]
+        cache["questions"][row] = question
+        cache["literals"][row] = question_literals(user_query)
+        cache["answers"][row] = answer
+
+    cache["matrix"][row] = embedding
+    cache["index"][question] = row
+    cache["stored_at"][row] = time.monotonic()
+    _touch(cache, row)
+
+# Persistent question -> SQL cache, so rephrasings of an earlier question skip
+# SQL generation even across sessions. Scoped per database and table.
+SQL_CACHE_PATH = ".sql_cache.db"
+SQL_CACHE_THRESHOLD = 0.92
+SQL_CACHE_TTL = 7 * 24 * 3600
+
+def _sql_cache_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(SQL_CACHE_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sql_cache (
+            workspace TEXT, table_name TEXT, question TEXT, sql TEXT,
+            embedding BLOB, created_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS sql_cache_scope ON sql_cache (workspace, table_name)")
+    return conn
+
+def sql_cache_lookup(workspace: str, table: str, embedding: np.ndarray, user_query: str) -> str:
+    try:
+        with closing(_sql_cache_db()) as conn:
+            rows = conn.execute(
+                "SELECT question, sql, embedding FROM sql_cache WHERE workspace = ? AND table_name = ? AND created_at >= ?",
+                (workspace, table, time.time() - SQL_CACHE_TTL)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Error reading SQL cache: {e}")
+        return None
+    if not rows:
+        return None
+
+    matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+    sims = matrix @ embedding.astype(np.float32)
+    # The SQL bakes in the question's numbers and values, so those must match exactly
+    literals = question_literals(user_query)
+    sims[[question_literals(row[0]) != literals for row in rows]] = -np.inf
+    best = int(np.argmax(sims))
+    if sims[best] < SQL_CACHE_THRESHOLD:
+        return None
+    logging.info(f"SQL cache hit ({sims[best]:.3f}) for cached question: {rows[best][0]}")
+    return rows[best][1]
+
+def sql_cache_store(workspace: str, table: str, user_query: str, sql_query: str, embedding: np.ndarray):
+    try:
+        with closing(_sql_cache_db()) as conn, conn:
+            conn.execute("DELETE FROM sql_cache WHERE created_at < ?", (time.time() - SQL_CACHE_TTL,))
+            conn.execute(
+                "INSERT INTO sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (workspace, table, user_query, sql_query, embedding.astype(np.float32).tobytes(), time.time())
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error writing SQL cache: {e}")
+
+# Pre-flight routes: only RUN pays for SQL generation, the query and the summary
+ROUTE_TRIVIAL = "TRIVIAL"
+ROUTE_GREETING = "GREETING"
+ROUTE_CACHED = "CACHED"
+ROUTE_RUN = "RUN"
+
+_GREETING_RE = re.compile(r'^\s*(hi|hello|hey|thanks|thank you|bye)\b[\s!.]*$', re.IGNORECASE)
+_CANNED_REPLIES = {
+    ROUTE_TRIVIAL: "Ask me a question about your data and I'll look it up.",
+    ROUTE_GREETING: "Hello! Ask me anything about your database.",
+}
+
+def _classify(user_query: str) -> str:
+    if not user_query or not user_query.strip():
+        return ROUTE_TRIVIAL
+    if _GREETING_RE.match(user_query):
+        return ROUTE_GREETING
+    return ROUTE_RUN
+
+def _response_stream(user_query: str, db: SQLDatabase, chat_history: Iterable[dict]) -> Iterator[str]:
+    route = _classify(user_query)
+    if route != ROUTE_RUN:
+        logging.info(f"Route: {route}")
+        yield _CANNED_REPLIES[route]
+        return
+
     try:
-        sql_query = get_sql_query(db, user_query, chat_history)
+        # Overlap the local embedding with the (network-bound) schema fetch;
+        # get_sql_query then reads the schema from the warm cache.
+        pool = get_executor()
+        schema_future = pool.submit(warm_schema_cache, db)
+        embedding_future = pool.submit(embed, user_query)
+        schema_future.result()
+
+        # Follow-ups depend on the chat history, which the answer cache doesn't key on
+        follow_up = is_follow_up(user_query)
+
+        # A repeated question is answered without waiting for its embedding
+        cached = None if follow_up else semantic_cache_exact(db, user_query)
+        if cached:
+            logging.info(f"Route: {ROUTE_CACHED}")
+            yield cached
+            return
+
+        try:
+            embedding = embedding_future.result()
+        except Exception as e:
+            logging.error(f"Error embedding question, skipping semantic cache: {e}")
+            embedding = None
+
+        if embedding is not None and not follow_up:
+            cached = semantic_cache_lookup(db, embedding, user_query)
+            if cached:
+                logging.info(f"Route: {ROUTE_CACHED}")
+                yield cached
+                return
+
+        logging.info(f"Route: {ROUTE_RUN}")
+
+        # Without an embedding get_sql_query neither reads nor writes the SQL cache
+        sql_query = get_sql_query(db, user_query, chat_history, None if follow_up else embedding)
         if not sql_query:
-            return "I'm sorry, I couldn't generate a SQL query for your question."
-
-        result = db.run(sql_query)
-
-        prompt = f"""
-        For the question: "{user_query}"
-        The SQL query: {sql_query}
-        Returned this result: {result}
-
-        Provide a clear and concise answer to the user's question.
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful data analyst."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=150,
-            temperature=0
-        )
-        return response.choices[0].message.content.strip()
+            yield "I'm sorry, I couldn't generate a SQL query for your question."
+            return
+
+        try:
+            columns, rows, truncated = pool.submit(fetch_rows_cached, db, bound_query(sql_query)).result(timeout=QUERY_CLIENT_TIMEOUT_S)
+        except Exception as e:
+            # A failed query has nothing to summarize, so the answer LLM call is skipped
+            logging.error(f"Error executing SQL query {sql_query}: {e}")
+            yield "I'm sorry, the query for your question failed to run against the database."
+            return
+        answer = direct_answer(user_query, columns, rows, truncated)
+        if answer is not None:
+            logging.info(f"Answering directly from {len(rows)} rows, skipping the summary LLM call")
+            if embedding is not None and not follow_up:
+                semantic_cache_store(db, embedding, user_query, answer)
+            yield answer
+            return
+
+        logging.info("Summarizing query result with the LLM")
+        result = format_rows(columns, rows, truncated)
+
+        prompt = ANSWER_TEMPLATE.format(question=user_query, query=sql_query, result=result)
+
+        chunks = []
+        for chunk in stream_chat([
+            ANSWER_SYSTEM_MESSAGE,
+            {"role": "user", "content": prompt}
+        ], max_tokens=ANSWER_MAX_TOKENS):
+            chunks.append(chunk)
+            yield chunk
+
+        if embedding is not None and not follow_up:
+            semantic_cache_store(db, embedding, user_query, "".join(chunks).strip())
     except Exception as e:
         logging.error(f"Error in get_response: {e}")
-        return "I'm sorry, I encountered an error while processing your request."
-
-def authenticate_gmail():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+        yield "I'm sorry, I encountered an error while processing your request."
+
+@st.cache_resource
+def _inflight_requests() -> Tuple[threading.Lock, Dict[str, Future]]:
+    # Shared by all sessions, so a double submit or a second tab can join the first run
+    return threading.Lock(), {}
+
+def _request_key(user_query: str, db: SQLDatabase, chat_history: Iterable[dict]) -> str:
+    recent = list(chat_history)[-3:]
+    payload = json.dumps([user_query, db_fingerprint(db) if db else "", recent], sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+# Longest a duplicate request waits on the first one: the SQL and answer LLM calls plus the query
+COALESCE_WAIT_S = 2 * OPENAI_TIMEOUT_S + QUERY_CLIENT_TIMEOUT_S
+
+def get_response_stream(user_query: str, db: SQLDatabase, chat_history: Iterable[dict]) -> Iterator[str]:
+    """Answer the question, coalescing identical requests that are already in flight."""
+    key = _request_key(user_query, db, chat_history)
+    lock, inflight = _inflight_requests()
+    with lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = inflight[key] = Future()
+
+    if not leader:
+        logging.info("Joining identical in-flight request")
+        try:
+            yield future.result(timeout=COALESCE_WAIT_S)
+            return
+        except Exception:
+            # The first run was abandoned mid-stream or is hung; answer independently
+            logging.warning("In-flight request failed or timed out; running this one separately")
+
+    chunks = []
+    try:
+        for chunk in _response_stream(user_query, db, chat_history):
+            chunks.append(chunk)
+            yield chunk
+        if leader:
+            future.set_result("".join(chunks))
+    finally:
+        if leader:
+            if not future.done():
+                future.set_exception(RuntimeError("Request abandoned before completion"))
+            with lock:
+                inflight.pop(key, None)
+
+def spin_until_first_token(stream: Iterator[str]) -> Iterator[str]:
+    # SQL generation and the query run before the first answer token, so keep
+    # the spinner up for that stretch and drop it once text starts arriving
+    with st.spinner("Thinking..."):
+        first = next(stream, None)
+    if first is not None:
+        yield first
+        yield from stream
+
+TOKEN_PATH = 'token.json'
+# Tokens this close to expiry are refreshed in the background on page load
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+def _save_token(creds):
+    # Write-then-rename so a concurrent refresh never leaves a truncated token.json
+    tmp_path = f"{TOKEN_PATH}.tmp"
+    with open(tmp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(tmp_path, TOKEN_PATH)
+
+def _refresh_in_background(creds):
+    def refresh():
+        try:
             creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+            _save_token(creds)
+        except Exception as e:
+            logging.error(f"Error refreshing Gmail token: {e}")
+    threading.Thread(target=refresh, daemon=True).start()
+
+@st.cache_data(show_spinner=False)
+def _client_secrets() -> dict:
+    with open('credentials.json') as secrets:
+        return json.load(secrets)
+
+def authenticate_gmail(interactive: bool = False):
+    """Load saved Gmail credentials; only run the browser OAuth flow when interactive."""
+    if interactive:
+        # Reconnecting always signs in again, possibly as a different account
+        st.session_state.pop('gmail_creds', None)
+        if os.path.exists(TOKEN_PATH):
+            os.remove(TOKEN_PATH)
+
+    # Reuse this session's credentials; token.json is only read once per session
+    creds = st.session_state.get('gmail_creds')
+    if creds is None and os.path.exists(TOKEN_PATH):
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+    if creds and creds.refresh_token:
+        if creds.expired:
+            # An expired token is unusable, so this refresh has to block
+            creds.refresh(Request())
+            _save_token(creds)
+        elif creds.expiry and creds.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+            _refresh_in_background(creds)
+    if creds and creds.valid:
+        st.session_state.gmail_creds = creds
+        return creds
+    if not interactive:
+        return None
+
+    # A fresh flow per sign-in (it holds per-attempt state), built from the cached config
+    flow = InstalledAppFlow.from_client_config(_client_secrets(), SCOPES)
+    creds = flow.run_local_server(port=0)
+    _save_token(creds)
+    st.session_state.gmail_creds = creds
     return creds
 
-def fetch_emails(service, query):
+# Gmail accepts at most 100 calls per batch request
+GMAIL_BATCH_SIZE = 100
+# Largest page messages.list allows
+GMAIL_PAGE_SIZE = 500
+# The list view only needs these headers; bodies are fetched when a row is opened
+GMAIL_SUMMARY_HEADERS = ['Subject', 'From', 'Date']
+GMAIL_SUMMARY_FIELDS = 'id,snippet,payload/headers'
+# Pages the Gmail tab fetches per search, to bound cost on large mailboxes
+GMAIL_UI_MAX_PAGES = 1
+# Partial response: only the fields _plain_text_body reads, not headers or attachments metadata
+GMAIL_MESSAGE_FIELDS = 'payload(mimeType,body/data,parts(mimeType,body/data,parts))'
+
+def _plain_text_body(msg) -> str:
+    """Decode the first text/plain part, including one nested in multipart containers."""
+    stack = [msg.get('payload', {})]
+    while stack:
+        part = stack.pop()
+        mime_type = part.get('mimeType')
+        data = part.get('body', {}).get('data')
+        if mime_type == 'text/plain' and data:
+            # urlsafe_b64decode takes the str directly; no ASCII round-trip needed
+            return base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
+        children = part.get('parts')
+        if children:
+            # Reversed so parts are visited in document order
+            stack.extend(reversed(children))
+    return None
+
+def list_message_ids(service, query, max_pages=None):
+    messages = []
+    page_token = None
+    pages = 0
+    while True:
+        result = service.users().messages().list(
+            userId='me', q=query, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token,
+            fields='messages/id,nextPageToken'
+        ).execute()
+        messages.extend(result.get('messages', []))
+        pages += 1
+        page_token = result.get('nextPageToken')
+        if not page_token or (max_pages is not None and pages >= max_pages):
+            return messages
+
+def _batch_get(service, message_ids, parse, **get_args) -> Dict[str, object]:
+    """messages.get every id through batch requests, returning {id: parse(response)}."""
+    results = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Error fetching email {request_id}: {exception}")
+            return
+        try:
+            results[request_id] = parse(response)
+        except Exception as e:
+            logging.error(f"Error decoding email {request_id}: {e}")
+
+    # One HTTP round-trip per batch instead of one per message
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for message_id in message_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=message_id, **get_args), request_id=message_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            # Keep whatever the other batches returned
+            logging.error(f"Error executing Gmail batch starting at message {start}: {e}")
+    return results
+
+def _email_summary(msg) -> dict:
+    headers = {header['name']: header['value'] for header in msg.get('payload', {}).get('headers', [])}
+    return {
+        'id': msg['id'],
+        'subject': headers.get('Subject', '(no subject)'),
+        'from': headers.get('From', ''),
+        'date': headers.get('Date', ''),
+        'snippet': html.unescape(msg.get('snippet', '')),
+    }
+
+def fetch_email_summaries(service, query, max_pages=None) -> List[dict]:
+    """Subject, sender, date and snippet per message, without downloading bodies."""
     try:
-        result = service.users().messages().list(userId='me', q=query).execute()
-        messages = result.get('messages', [])
-        emails = []
-        for msg in messages:
-            msg = service.users().messages().get(userId='me', id=msg['id']).execute()
-            payload = msg.get('payload', {})
-            parts = payload.get('parts', [])
-            for part in parts:
-                if part.get('mimeType') == 'text/plain':
-                    data = part.get('body', {}).get('data')
-                    if data:
-                        text = base64.urlsafe_b64decode(data.encode('ASCII')).decode('utf-8')
-                        emails.append(text)
-        return emails
+        message_ids = [msg['id'] for msg in list_message_ids(service, query, max_pages)]
+        summaries = _batch_get(
+            service, message_ids, _email_summary,
+            format='metadata', metadataHeaders=GMAIL_SUMMARY_HEADERS, fields=GMAIL_SUMMARY_FIELDS
+        )
+        return [summaries[message_id] for message_id in message_ids if message_id in summaries]
     except Exception as e:
-        logging.error(f"Error fetching emails: {e}")
+        logging.error(f"Error fetching email summaries: {e}")
         return []
 
-def get_gmail_service():
-    creds = authenticate_gmail()
-    return build('gmail', 'v1', credentials=creds)
+def fetch_email_body(service, message_id) -> str:
+    try:
+        msg = service.users().messages().get(userId='me', id=message_id, format='full', fields=GMAIL_MESSAGE_FIELDS).execute()
+        return _plain_text_body(msg)
+    except Exception as e:
+        logging.error(f"Error fetching email {message_id}: {e}")
+        return None
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_email_summaries(query: str, account_key: str, _service) -> List[dict]:
+    # _service is not hashed by Streamlit; account_key keeps one user's mail from another's
+    return fetch_email_summaries(_service, query, max_pages=GMAIL_UI_MAX_PAGES)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_email_body(message_id: str, account_key: str, _service) -> str:
+    return fetch_email_body(_service, message_id)
+
+def gmail_account_key(creds) -> str:
+    """Identifies the signed-in user; the OAuth client_id is shared by every user."""
+    secret = creds.refresh_token or creds.token
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _gmail_service_for(account_key: str, _creds):
+    # static_discovery uses the discovery document bundled with the client library
+    return build('gmail', 'v1', credentials=_creds, static_discovery=True)
+
+def get_gmail_service(interactive: bool = False):
+    if interactive:
+        _cached_email_summaries.clear()
+        _cached_email_body.clear()
+    creds = authenticate_gmail(interactive)
+    if creds is None:
+        st.session_state.pop('gmail_account', None)
+        return None
+    st.session_state.gmail_account = gmail_account_key(creds)
+    return _gmail_service_for(st.session_state.gmail_account, creds)
+
+_CSS = """
+<style>
+    .main {background-color: #f0f2f6;}
+    .stApp {max-width: 1200px; margin: 0 auto;}
+    .stButton>button {background-color: #4CAF50; color: white; border-radius: 5px;}
+    .stTextInput>div>div>input {background-color: #ffffff;}
+    .stChatMessage {background-color: #ffffff; border-radius: 10px; padding: 10px; margin-bottom: 10px;}
+</style>
+"""
+
+# Sidebar navigation; labels double as the page keys main() dispatches on
+MENU_OPTIONS = ["Chat", "Database Connection", "Gmail Connection", "About"]
+MENU_ICONS = ["chat-dots", "database", "envelope", "info-circle"]
+
+@st.cache_resource(show_spinner=False)
+def _sidebar_image() -> Image.Image:
+    # Decode the logo once per process; copy() detaches it from the closed file
+    with Image.open('f.png') as image:
+        return image.copy()
+
+# Chat messages drawn on every rerun; the rest sit behind a toggle
+CHAT_VISIBLE_MESSAGES = 10
+
+def render_message(message: dict):
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+
+_ROLE_ICONS = {"user": "👤", "assistant": "🤖"}
+
+def earlier_messages_markdown(messages: List[dict]) -> str:
+    # The label gets its own paragraph so block content (e.g. a markdown table) still renders
+    return "\n\n".join(f"**{_ROLE_ICONS.get(m['role'], m['role'])}**\n\n{m['content']}" for m in messages)
 
 def main():
     st.set_page_config(page_title="Data Insights Chat", page_icon="🔍", layout="wide")
 
     
-    st.markdown("""
-    <style>
-        .main {background-color: #f0f2f6;}
-        .stApp {max-width: 1200px; margin: 0 auto;}
-        .stButton>button {background-color: #4CAF50; color: white; border-radius: 5px;}
-        .stTextInput>div>div>input {background-color: #ffffff;}
-        .stChatMessage {background-color: #ffffff; border-radius: 10px; padding: 10px; margin-bottom: 10px;}
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(_CSS, unsafe_allow_html=True)
 
     if 'user' not in st.session_state:
         st.session_state.user = None
@@ -200,13 +1060,15 @@ def main():
             st.markdown(f'<a href="{authorization_url}" target="_self">Click here to login</a>', unsafe_allow_html=True)
 
         # Check if the user has returned from the OAuth flow
-        if 'code' in st.query_params():
-            code = st.query_params()['code'][0]
+        code = st.query_params.get('code')
+        if code:
             flow.fetch_token(code=code)
+            # The code is single-use; leaving it in the URL would re-exchange it on the next rerun
+            st.query_params.clear()
             credentials = flow.credentials
-            user_info = build('oauth2', 'v2', credentials=credentials).userinfo().get().execute()
+            user_info = build('oauth2', 'v2', credentials=credentials, static_discovery=True).userinfo().get().execute()
             st.session_state.user = user_info
-            st.experimental_rerun()
+            st.rerun()
     else:
         # User is logged in
         st.write(f"Welcome, {st.session_state.user['name']}!")
@@ -214,43 +1076,47 @@ def main():
         st.title("How can I help you?")
 
         with st.sidebar:
-            image = Image.open('f.png')
-            st.image(image, width=200)
+            st.image(_sidebar_image(), width=200)
             st.title("Data Insights Chat")
             
             selected = option_menu(
                 menu_title="Main Menu",
-                options=["Chat", "Database Connection", "Gmail Connection", "About"],
-                icons=["chat-dots", "database", "envelope", "info-circle"],
+                options=MENU_OPTIONS,
+                icons=MENU_ICONS,
                 menu_icon="cast",
                 default_index=0,
             )
 
         if "chat_history" not in st.session_state:
-            st.session_state.chat_history = [
-                AIMessage(content="Hello! I'm your data assistant. Ask me anything about your database."),
-            ]
+            st.session_state.chat_history = collections.deque([
+                {"role": "assistant", "content": "Hello! I'm your data assistant. Ask me anything about your database."},
+            ])
 
         if selected == "Chat":
             st.header("Chat with Your Data 💬")
             
-            for message in st.session_state.chat_history:
-                with st.chat_message("assistant" if isinstance(message, AIMessage) else "user"):
-                    st.markdown(message.content)
+            # Only the most recent messages are drawn on every rerun; older ones
+            # are rendered only when the user asks for them
+            history = list(st.session_state.chat_history)
+            older, visible = history[:-CHAT_VISIBLE_MESSAGES], history[-CHAT_VISIBLE_MESSAGES:]
+            if older and st.toggle(f"Show earlier messages ({len(older)})"):
+                # One markdown element for the whole backlog instead of a chat bubble each
+                st.markdown(earlier_messages_markdown(older))
+            for message in visible:
+                render_message(message)
             
             user_query = st.chat_input("Ask me about your data...")
             if user_query:
-                st.session_state.chat_history.append(HumanMessage(content=user_query))
+                st.session_state.chat_history.append({"role": "user", "content": user_query})
                 
                 with st.chat_message("user"):
                     st.markdown(user_query)
                 
                 with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        response = get_response(user_query, st.session_state.get('db'), st.session_state.chat_history)
-                    st.markdown(response)
+                    response = st.write_stream(spin_until_first_token(get_response_stream(user_query, st.session_state.get('db'), st.session_state.chat_history)))
                 
-                st.session_state.chat_history.append(AIMessage(content=response))
+                st.session_state.chat_history.append({"role": "assistant", "content": response})
+                compact_history(st.session_state.chat_history)
 
         elif selected == "Database Connection":
             st.header("Connect to Your Database 🔌")
@@ -265,28 +1131,65 @@ def main():
                 if st.form_submit_button("Connect"):
                     with st.spinner("Connecting to database..."):
                         db = init_database(user, password, host, port, database)
+                        clear_schema_caches()
+                        _cached_rows.clear()
                         if db:
                             st.session_state.db = db
+                            try:
+                                warm_schema_cache(db)
+                            except Exception as e:
+                                logging.error(f"Error loading database schema: {e}")
                             st.success("🎉 Connected to database successfully!")
                         else:
                             st.error("❌ Failed to connect to the database. Please check your credentials and try again.")
 
+            # The schema is cached for a few minutes; reload it right away after DDL changes
+            if st.session_state.get("db") is not None and st.button("Refresh schema"):
+                with st.spinner("Reloading schema..."):
+                    clear_schema_caches()
+                    try:
+                        warm_schema_cache(st.session_state.db)
+                        st.success("Schema reloaded.")
+                    except Exception as e:
+                        logging.error(f"Error loading database schema: {e}")
+                        st.error("❌ Failed to reload the database schema.")
+
         elif selected == "Gmail Connection":
             st.header("Connect to Your Gmail 📧")
             
-            if "gmail_service" not in st.session_state:
+            if st.session_state.get("gmail_service") is None:
                 st.session_state.gmail_service = get_gmail_service()
-            
-            st.success("🎉 Connected to Gmail successfully!")
-            email_query = st.text_input("Search Emails", placeholder="e.g., orders, payments, meetings")
-            
-            if st.button("Fetch Emails"):
-                with st.spinner("Fetching emails..."):
-                    emails = fetch_emails(st.session_state.gmail_service, email_query)
-                    if emails:
+
+            # The interactive OAuth flow blocks until the browser round-trip
+            # completes, so it only runs on an explicit request
+            if st.button("Reconnect Gmail"):
+                with st.spinner("Waiting for Google sign-in..."):
+                    st.session_state.gmail_service = get_gmail_service(interactive=True)
+
+            if st.session_state.gmail_service is None:
+                st.info("Gmail is not connected yet. Click \"Reconnect Gmail\" to sign in.")
+            else:
+                st.success("🎉 Connected to Gmail successfully!")
+                email_query = st.text_input("Search Emails", placeholder="e.g., orders, payments, meetings")
+
+                if st.button("Fetch Emails"):
+                    st.session_state.email_query = email_query
+
+                # Reruns re-render the last search from the cache instead of re-hitting Gmail
+                if "email_query" in st.session_state:
+                    with st.spinner("Fetching emails..."):
+                        summaries = _cached_email_summaries(st.session_state.email_query, st.session_state.gmail_account, st.session_state.gmail_service)
+                    if summaries:
                         st.write("Fetched Emails:")
-                        for email in emails:
-                            st.markdown(email)
+                        open_emails = st.session_state.setdefault("open_emails", set())
+                        for summary in summaries:
+                            st.markdown(f"**{summary['subject']}**  \n{summary['from']} · {summary['date']}  \n{summary['snippet']}")
+                            if summary['id'] in open_emails:
+                                body = _cached_email_body(summary['id'], st.session_state.gmail_account, st.session_state.gmail_service)
+                                st.markdown(body or "_No plain-text body._")
+                            elif st.button("Show body", key=f"email_{summary['id']}"):
+                                open_emails.add(summary['id'])
+                                st.rerun()
                     else:
                         st.write("No emails found for the given query.")
 
@@ -307,7 +1210,7 @@ def main():
 
         if st.button("Logout"):
             st.session_state.user = None
-            st.experimental_rerun()
+            st.rerun()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
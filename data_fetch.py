@@ -1,5 +1,6 @@
+import re
 import requests
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import mysql.connector
 from mysql.connector import Error
 from frappeclient import FrappeClient
@@ -11,55 +12,112 @@ mysql_user = ""
 mysql_password = ""
 mysql_database = ""
 
+# Records requested from Frappe per call
+PAGE_SIZE = 2000
+# Pages requested from Frappe concurrently; kept small to respect rate limits
+FETCH_CONCURRENCY = 4
+# Rows per executemany call
+INSERT_BATCH_SIZE = 1000
+
+# Table and column names are interpolated into DDL, so only plain identifiers are allowed
+_IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
 url = ""
 api_key = ""
 secret_key = ""
 
-def fetch_all_data(doctype):
+def iter_pages(doctype, page_size=PAGE_SIZE):
+    """Yield the doctype's records one page (a list of dicts) at a time, in order.
+
+    Up to FETCH_CONCURRENCY pages are requested at once, so their HTTP
+    latency overlaps instead of adding up.
+    """
     client = FrappeClient(url)
     client.authenticate(api_key, secret_key)
 
-    try:
-        items = client.get_list(doctype, limit_start=0, limit_page_length=25000)
-        df = pd.DataFrame(items)
-        return df
-    except Exception as e:
-        if hasattr(e, 'response') and e.response.status_code == 400:
-            print("Failed to fetch data. Status code:", e.response.status_code)
-            print("Response content:", e.response.content)
-            return None
-        else:
-            raise e
+    def fetch_page(start):
+        # A stable order keeps offsets consistent; the default "modified desc" shifts
+        # rows between pages when records change mid-import
+        return client.get_list(doctype, limit_start=start, limit_page_length=page_size, order_by="name asc")
+
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as pool:
+        start = 0
+        while True:
+            starts = range(start, start + FETCH_CONCURRENCY * page_size, page_size)
+            futures = [pool.submit(fetch_page, page_start) for page_start in starts]
+            for future in futures:
+                try:
+                    items = future.result()
+                except Exception as e:
+                    response = getattr(e, 'response', None)
+                    if response is not None and response.status_code == 400:
+                        print("Failed to fetch data. Status code:", response.status_code)
+                        print("Response content:", response.content)
+                    # Stopping quietly would pass a partial import off as complete
+                    raise e
+                if items:
+                    yield items
+                if len(items) < page_size:
+                    # Past the last record; later pages in this round are empty
+                    return
+            start += FETCH_CONCURRENCY * page_size
+
+def quote_identifier(name):
+    """Backtick-quote a table or column name, rejecting anything but letters, digits and _."""
+    if not _IDENTIFIER_RE.match(name):
+        raise ValueError(f"Invalid MySQL identifier: {name!r}")
+    return f"`{name}`"
 
-def save_to_mysql(df, table_name):
+def save_to_mysql(pages, table_name):
+    """Insert each page as it arrives, so only one page is held in memory."""
     conn = None
+    saved = 0
     try:
         conn = mysql.connector.connect(
             host=mysql_host,
             port=mysql_port,
             user=mysql_user,
             password=mysql_password,
-            database=mysql_database
+            database=mysql_database,
+            use_pure=False
         )
         if conn.is_connected():
             cursor = conn.cursor()
-            # Creating table if it doesn't exist
-            create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                {', '.join([f"{col} TEXT" for col in df.columns])}
-            )
-            """
-            cursor.execute(create_table_query)
-            conn.commit()
+            columns = None
+            for page in pages:
+                if columns is None:
+                    # The first page decides the columns; the table is created once
+                    columns = list(page[0].keys())
+                    table = quote_identifier(table_name)
+                    quoted_columns = [quote_identifier(col) for col in columns]
+                    create_table_query = f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        {', '.join([f"{col} TEXT" for col in quoted_columns])}
+                    )
+                    """
+                    cursor.execute(create_table_query)
+                    conn.commit()
+                    # Built once; only the values vary between batches
+                    insert_query = f"INSERT INTO {table} ({', '.join(quoted_columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
 
-            # Inserting data
-            for _, row in df.iterrows():
-                insert_query = f"INSERT INTO {table_name} ({', '.join(df.columns)}) VALUES ({', '.join(['%s'] * len(row))})"
-                cursor.execute(insert_query, tuple(row))
-            conn.commit()
-            print(f"Data saved to MySQL database '{mysql_database}' in table '{table_name}'")
-    except Error as e:
+                # Inserting data in batches; executemany sends each batch as one multi-row INSERT
+                rows = [tuple(item.get(col) for col in columns) for item in page]
+                for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                    cursor.executemany(insert_query, rows[start:start + INSERT_BATCH_SIZE])
+                conn.commit()
+                saved += len(rows)
+            if columns is None:
+                print("No data to save.")
+                return False
+            print(f"Saved {saved} rows to MySQL database '{mysql_database}' in table '{table_name}'")
+            return True
+    except (Error, ValueError) as e:
         print(f"Error: {e}")
+        return False
+    except requests.RequestException as e:
+        # A page failed to fetch; whatever was saved before it is incomplete
+        print(f"Import stopped after {saved} rows: {e}")
+        return False
     finally:
         if conn and conn.is_connected():
             cursor.close()
@@ -70,8 +128,5 @@ if __name__ == "__main__":
     doctype = ""  # Replace with the desired doctype
     table_name = doctype.lower().replace(' ', '_')
 
-    df = fetch_all_data(doctype)
-    if df is not None:
-        save_to_mysql(df, table_name)
-    else:
+    if not save_to_mysql(iter_pages(doctype), table_name):
         print("Failed to fetch data.")
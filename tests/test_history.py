@@ -0,0 +1,53 @@
+import collections
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+app = pytest.importorskip("app")
+
+
+class _WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    """Replace the summary LLM call, recording each transcript it is given."""
+    transcripts = []
+
+    def fake_chat(messages, **kwargs):
+        transcripts.append(messages[-1]["content"])
+        return f"S{len(transcripts)}"
+
+    monkeypatch.setattr(app, "cached_chat", fake_chat)
+    monkeypatch.setattr(app, "get_tokenizer", lambda: _WordTokenizer())
+    return transcripts
+
+
+def _chat(history, turns):
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"question {turn}"})
+        history.append({"role": "assistant", "content": f"answer {turn}"})
+        app.compact_history(history)
+
+
+def test_compaction_folds_previous_summary(summarizer):
+    history = collections.deque([{"role": "assistant", "content": "Hello!"}])
+    _chat(history, 30)
+
+    assert len(summarizer) >= 3
+    for previous, transcript in enumerate(summarizer[1:], start=1):
+        assert f"{app.SUMMARY_PREFIX}S{previous}" in transcript
+    assert history[0]["content"] == f"{app.SUMMARY_PREFIX}S{len(summarizer)}"
+    assert len(history) <= app.CHAT_HISTORY_SIZE
+
+
+def test_recent_history_starts_with_summary(summarizer):
+    history = collections.deque([{"role": "assistant", "content": "Hello!"}])
+    _chat(history, 15)
+
+    text = app._recent_history_text(history, max_tokens=20)
+    assert text.startswith(f"assistant: {app.SUMMARY_PREFIX}S{len(summarizer)}")
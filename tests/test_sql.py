@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+app = pytest.importorskip("app")
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT 1 LIMIT 5; DELETE FROM t",
+    "SELECT * FROM t;DROP TABLE t;",
+    "SQL: SELECT name FROM t; UPDATE t SET name = 'x'",
+])
+def test_stacked_queries_are_rejected(query):
+    assert app.clean_sql_query(query) is None
+
+
+def test_single_select_is_kept():
+    assert app.clean_sql_query("SQL: SELECT name FROM t WHERE note = 'a;b';") == "SELECT name FROM t WHERE note = 'a;b'"